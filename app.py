@@ -1,16 +1,31 @@
 # app.py
-import os, time, json, hashlib, requests, re, threading
-from datetime import datetime, timezone
-from flask import Flask, request, jsonify
+import os, sys, time, json, hashlib, hmac, requests, re, threading, random, gzip, heapq, sqlite3, contextvars, csv, itertools
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
+from flask import Flask, request, jsonify, g, Response, stream_with_context
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+try:
+    import brotli  # opcional: sem ele a UI sai só em gzip/identity
+except ImportError:
+    brotli = None
+try:
+    import orjson  # opcional: codec JSON rápido
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
+_BOOT_TS = time.monotonic()
 
 # ========= SeaTalk Endpoints =========
-AUTH_URL        = "https://openapi.seatalk.io/auth/app_access_token"
-CONTACTS_URL    = "https://openapi.seatalk.io/contacts/v2/get_employee_code_with_email"
-SINGLE_DM_URL   = "https://openapi.seatalk.io/messaging/v2/single_chat"
-GROUP_DM_URL    = "https://openapi.seatalk.io/messaging/v2/group_chat"
-UPDATE_URL      = "https://openapi.seatalk.io/messaging/v2/update"  # não será usado, mas mantido p/ referência
+SEATALK_API_BASE = (os.getenv("SEATALK_API_BASE") or "https://openapi.seatalk.io").rstrip("/")  # sobrescrever só p/ testes/bench
+AUTH_URL        = f"{SEATALK_API_BASE}/auth/app_access_token"
+CONTACTS_URL    = f"{SEATALK_API_BASE}/contacts/v2/get_employee_code_with_email"
+SINGLE_DM_URL   = f"{SEATALK_API_BASE}/messaging/v2/single_chat"
+GROUP_DM_URL    = f"{SEATALK_API_BASE}/messaging/v2/group_chat"
+UPDATE_URL      = f"{SEATALK_API_BASE}/messaging/v2/update"  # não será usado, mas mantido p/ referência
 
 # ========= Config (env) =========
 SEATALK_APP_ID         = (os.getenv("SEATALK_APP_ID") or "").strip()
@@ -18,10 +33,117 @@ SEATALK_APP_SECRET     = (os.getenv("SEATALK_APP_SECRET") or "").strip()
 SEATALK_SIGNING_SECRET = (os.getenv("SEATALK_SIGNING_SECRET") or "").strip()
 UI_ADMIN_TOKEN         = (os.getenv("UI_ADMIN_TOKEN") or "").strip()
 
+# Tempo máximo que o /callback segura a resposta; o que não couber segue em background
+CALLBACK_DEADLINE_SEC  = float(os.getenv("CALLBACK_DEADLINE_SEC") or "3")
+BACKGROUND_WORKERS     = int(os.getenv("BACKGROUND_WORKERS") or "8")
+BACKGROUND_MAX_PENDING = int(os.getenv("BACKGROUND_MAX_PENDING") or "200")
+
+# Limites de requisições simultâneas por classe de rota (health/status não entram)
+MAX_INFLIGHT = {
+    "callback": int(os.getenv("MAX_INFLIGHT_CALLBACK") or "16"),
+    "send":     int(os.getenv("MAX_INFLIGHT_SEND") or "4"),
+    "ui":       int(os.getenv("MAX_INFLIGHT_UI") or "8"),
+}
+RETRY_AFTER_SEC        = int(os.getenv("RETRY_AFTER_SEC") or "2")
+
+# Loga requisições mais lentas que isso com o detalhamento por fase (0 = desligado)
+SLOW_REQUEST_MS        = float(os.getenv("SLOW_REQUEST_MS") or "0")
+
+# Callback abaixo deste tempo conta como "rápido" (métrica de warm-up)
+FAST_CALLBACK_MS       = float(os.getenv("FAST_CALLBACK_MS") or "500")
+
 # Defaults (se a UI não enviar sheet_id/sheet_name)
 GOOGLE_SHEET_ID   = (os.getenv("GOOGLE_SHEET_ID") or "").strip()
 GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME", "seatalk_logs")
 
+# ========= JSON codec =========
+# JSON_CODEC=auto (orjson se instalado) | orjson | stdlib
+JSON_CODEC = (os.getenv("JSON_CODEC") or "auto").strip().lower()
+if JSON_CODEC == "orjson" and orjson is None:
+    raise RuntimeError("JSON_CODEC=orjson mas o pacote orjson não está instalado")
+
+if orjson is not None and JSON_CODEC in ("auto", "orjson"):
+    JSON_CODEC = "orjson"
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps  # bytes UTF-8, sem escapes ASCII
+else:
+    JSON_CODEC = "stdlib"
+    _json_loads = json.loads
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# ========= Circuit breakers (por upstream) =========
+BREAKER_FAIL_THRESHOLD = int(os.getenv("BREAKER_FAIL_THRESHOLD") or "5")
+BREAKER_RESET_SEC      = float(os.getenv("BREAKER_RESET_SEC") or "30")
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class _Breaker:
+    """
+    closed -> open após N falhas seguidas; open falha na hora (sem esperar timeout);
+    após BREAKER_RESET_SEC vira half_open e deixa passar UMA chamada de teste.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def before(self):
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_RESET_SEC:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"upstream {self.name} indisponível (circuit {self.state})")
+
+    def record(self, ok: bool):
+        with self.lock:
+            self.probing = False
+            if ok:
+                self.state, self.failures = "closed", 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= BREAKER_FAIL_THRESHOLD:
+                if self.state != "open":
+                    print(f"circuit {self.name} -> open ({self.failures} falhas)")
+                self.state, self.opened_at = "open", time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+_breakers = {n: _Breaker(n) for n in ("auth", "contacts", "single_chat", "group_chat", "sheets")}
+
+# Sessão compartilhada: reaproveita conexões TLS com openapi.seatalk.io entre chamadas
+_http = requests.Session()
+_http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=BACKGROUND_WORKERS + sum(MAX_INFLIGHT.values())))
+
+def _post(upstream: str, url: str, **kw):
+    """POST protegido pelo breaker do upstream; 5xx e erros de rede contam como falha."""
+    if "json" in kw:
+        # corpo serializado pelo codec configurado em vez do json da stdlib dentro do requests
+        kw["data"] = _json_dumps(kw.pop("json"))
+        kw["headers"] = {"Content-Type": "application/json", **(kw.get("headers") or {})}
+    br = _breakers[upstream]
+    br.before()
+    try:
+        with _span("send" if upstream.endswith("_chat") else upstream):
+            r = _http.post(url, **kw)
+    except requests.RequestException:
+        br.record(False)
+        raise
+    br.record(r.status_code < 500)
+    return r
+
 # ========= Google Sheets (Service Account via gspread) =========
 _gspread_client = None
 def _get_gspread_client():
@@ -49,6 +171,19 @@ def _ensure_headers(ws):
             "timestamp_utc", "email_or_id", "action", "message_id", "group_id"
         ]])
 
+def _is_sheets_outage(e: Exception) -> bool:
+    """Só erro de rede e 5xx (APIError do gspread traz .response) contam para o breaker."""
+    try:
+        from google.auth.exceptions import TransportError as GoogleTransportError
+    except ImportError:
+        GoogleTransportError = ()
+    if isinstance(e, GoogleTransportError):
+        return True
+    resp = getattr(e, "response", None)
+    if resp is None:
+        return isinstance(e, requests.RequestException)
+    return getattr(resp, "status_code", 0) >= 500
+
 def _append_click_row(ts_iso, email_or_id, action, message_id, group_id, sheet_id=None, sheet_name=None):
     """Grava no Sheets; se sheet_id/name não vierem, usa os defaults das env vars."""
     sid = (sheet_id or GOOGLE_SHEET_ID or "").strip()
@@ -56,14 +191,23 @@ def _append_click_row(ts_iso, email_or_id, action, message_id, group_id, sheet_i
     if not sid:
         return  # sem planilha definida, não grava
 
-    gc = _get_gspread_client()
-    sh = gc.open_by_key(sid)
-    try:
-        ws = sh.worksheet(sname)
-    except Exception:
-        ws = sh.add_worksheet(sname, rows=100, cols=10)
-    _ensure_headers(ws)
-    ws.append_row([ts_iso, email_or_id, action, message_id, group_id], value_input_option="USER_ENTERED")
+    with _span("sheets"):
+        gc = _get_gspread_client()
+        br = _breakers["sheets"]
+        br.before()
+        try:
+            sh = gc.open_by_key(sid)
+            try:
+                ws = sh.worksheet(sname)
+            except Exception:
+                ws = sh.add_worksheet(sname, rows=100, cols=10)
+            _ensure_headers(ws)
+            ws.append_row([ts_iso, email_or_id, action, message_id, group_id], value_input_option="USER_ENTERED")
+        except Exception as e:
+            # planilha inexistente/sem permissão é erro do botão, não queda do Sheets
+            br.record(not _is_sheets_outage(e))
+            raise
+        br.record(True)
 
 # ========= Token cache =========
 _token = {"v": None, "exp": 0}
@@ -73,8 +217,8 @@ def get_token():
     now = int(time.time())
     if _token["v"] and now < _token["exp"] - 60:
         return _token["v"]
-    r = requests.post(AUTH_URL, json={"app_id": SEATALK_APP_ID, "app_secret": SEATALK_APP_SECRET}, timeout=10)
-    data = r.json()
+    r = _post("auth", AUTH_URL, json={"app_id": SEATALK_APP_ID, "app_secret": SEATALK_APP_SECRET}, timeout=10)
+    data = _json_loads(r.content)
     token = data.get("access_token") or data.get("app_access_token")
     exp   = now + int(data.get("expires_in") or data.get("expire") or 7200)
     if not token:
@@ -82,39 +226,132 @@ def get_token():
     _token.update({"v": token, "exp": exp})
     return token
 
+# ========= Retry (por destinatário) =========
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS") or "3")
+RETRY_BASE_SEC     = float(os.getenv("RETRY_BASE_SEC") or "0.5")
+RETRY_MAX_SEC      = float(os.getenv("RETRY_MAX_SEC") or "5")
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO") or "0.2")  # retries por chamada original
+RETRY_BUDGET_MAX   = float(os.getenv("RETRY_BUDGET_MAX") or "10")     # saldo máximo (rajada)
+
+# códigos SeaTalk de token inválido/expirado
+SEATALK_TOKEN_ERRORS = {100}
+
+class TokenExpiredError(RuntimeError):
+    pass
+
+def _seatalk_json(r) -> dict:
+    """raise_for_status + json; token expirado vira TokenExpiredError (retentável)."""
+    r.raise_for_status()
+    j = _json_loads(r.content)
+    if j.get("code") in SEATALK_TOKEN_ERRORS:
+        raise TokenExpiredError(f"token expirado: {j}")
+    return j
+
+# Orçamento global: cada chamada deposita RETRY_BUDGET_RATIO, cada retry consome 1.
+# Assim, em uma queda, os retries não multiplicam a carga sobre o upstream.
+_retry_budget = {"tokens": RETRY_BUDGET_MAX, "retries": 0, "exhausted": 0}
+_retry_lock = threading.Lock()
+
+def _retry_deposit():
+    with _retry_lock:
+        _retry_budget["tokens"] = min(RETRY_BUDGET_MAX, _retry_budget["tokens"] + RETRY_BUDGET_RATIO)
+
+def _retry_withdraw() -> bool:
+    with _retry_lock:
+        if _retry_budget["tokens"] < 1:
+            _retry_budget["exhausted"] += 1
+            return False
+        _retry_budget["tokens"] -= 1
+        _retry_budget["retries"] += 1
+        return True
+
+def _is_retryable(e: Exception, idempotent: bool = False) -> bool:
+    """
+    ReadTimeout num envio normalmente significa que o SeaTalk já aceitou a
+    mensagem: só chamadas idempotentes (resolve) repetem em qualquer timeout.
+    """
+    if isinstance(e, CircuitOpenError):
+        return False
+    if isinstance(e, (TokenExpiredError, requests.ConnectionError)):  # inclui ConnectTimeout
+        return True
+    if isinstance(e, requests.Timeout):
+        return idempotent
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 or e.response.status_code in (401, 429)
+    return False
+
+def _call_with_retry(fn, stats: dict, idempotent: bool = False):
+    """
+    Executa fn(token) com retry + backoff exponencial com jitter (full jitter).
+    stats["attempts"] é incrementado a cada tentativa (reportado por destinatário).
+    """
+    _retry_deposit()
+    attempt = 0
+    while True:
+        attempt += 1
+        stats["attempts"] = stats.get("attempts", 0) + 1
+        try:
+            return fn(get_token())
+        except Exception as e:
+            if attempt >= RETRY_MAX_ATTEMPTS or not _is_retryable(e, idempotent) or not _retry_withdraw():
+                raise
+            token_error = isinstance(e, TokenExpiredError) or (
+                isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 401)
+            if token_error:
+                _token.update({"v": None, "exp": 0})  # força renovação; tenta de novo sem esperar
+                continue
+            time.sleep(random.uniform(0, min(RETRY_MAX_SEC, RETRY_BASE_SEC * 2 ** (attempt - 1))))
+
 # ========= Helpers =========
 def expected_signature(raw: bytes) -> str:
     if not SEATALK_SIGNING_SECRET:
         return ""
     return hashlib.sha256(raw + SEATALK_SIGNING_SECRET.encode()).hexdigest()
 
-def _extract_action(value):
-    if isinstance(value, str):
+def signature_matches(raw: bytes, sig: str) -> bool:
+    """Compara em tempo constante; loga a divergência (ainda não rejeita a requisição)."""
+    calc = expected_signature(raw)
+    if sig and hmac.compare_digest(calc.encode(), sig.strip().lower().encode()):
+        return True
+    print("signature mismatch", sig, calc)
+    return False
+
+def _target_list(v) -> list:
+    """emails/group_ids: lista JSON ou string separada por vírgula/quebra de linha."""
+    if isinstance(v, str):
+        return [s.strip() for s in v.replace(",", "\n").split("\n") if s.strip()]
+    return [str(x).strip() for x in (v or []) if str(x).strip()]
+
+def card_message(elements: list) -> dict:
+    return {"tag": "interactive_message", "interactive_message": {"elements": elements}}
+
+def text_message(text: str) -> dict:
+    return {"tag": "text", "text": {"content": text}}
+
+def _decode_value(value) -> dict:
+    """Decodifica evt.value (string JSON ou dict) uma única vez; {} se inválido."""
+    if isinstance(value, (str, bytes)):
         try:
-            value = json.loads(value)
+            value = _json_loads(value)
         except Exception:
-            return "-"
-    if isinstance(value, dict):
-        return str(value.get("acao", "-"))
-    return "-"
+            return {}
+    return value if isinstance(value, dict) else {}
+
+def _extract_action(value):
+    value = _decode_value(value)
+    return str(value.get("acao", "-")) if value else "-"
 
 def _extract_sheet_meta(value) -> dict:
     """Extrai sheet_id e sheet_name de evt.value (string JSON ou dict)."""
-    try:
-        if isinstance(value, str):
-            value = json.loads(value)
-        if isinstance(value, dict):
-            sid = str(value.get("sheet_id") or "").strip()
-            sname = str(value.get("sheet_name") or "").strip()
-            out = {}
-            if sid:
-                out["sheet_id"] = sid
-            if sname:
-                out["sheet_name"] = sname
-            return out
-    except Exception:
-        pass
-    return {}
+    value = _decode_value(value)
+    sid = str(value.get("sheet_id") or "").strip()
+    sname = str(value.get("sheet_name") or "").strip()
+    out = {}
+    if sid:
+        out["sheet_id"] = sid
+    if sname:
+        out["sheet_name"] = sname
+    return out
 
 def _is_http_url(u: str) -> bool:
     return bool(re.match(r"^https?://", (u or "").strip(), flags=re.I))
@@ -197,9 +434,8 @@ def update_card(message_id: str, elements: list):
 
 def resolve_employee_code(token: str, email: str) -> str:
     h = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    r = requests.post(CONTACTS_URL, headers=h, json={"emails": [email]}, timeout=10)
-    r.raise_for_status()
-    j = r.json()
+    r = _post("contacts", CONTACTS_URL, headers=h, json={"emails": [email]}, timeout=10)
+    j = _seatalk_json(r)
     if j.get("code") != 0 or not j.get("employees"):
         raise RuntimeError(f"Falha employee_code para {email}: {j}")
     emp = next((e for e in j["employees"] if e.get("employee_status") == 2), None)
@@ -207,50 +443,191 @@ def resolve_employee_code(token: str, email: str) -> str:
         raise RuntimeError(f"Usuário inativo: {email}")
     return emp["employee_code"]
 
-def send_card_to_employee(token: str, employee_code: str, elements: list):
+def send_to_employee(token: str, employee_code: str, message: dict):
     h = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    payload = {"employee_code": employee_code,
-               "message": {"tag": "interactive_message", "interactive_message": {"elements": elements}}}
-    r = requests.post(SINGLE_DM_URL, headers=h, json=payload, timeout=10)
-    print("send single:", r.status_code, r.text)
-    r.raise_for_status()
-    return r.json()
+    payload = {"employee_code": employee_code, "message": message}
+    r = _post("single_chat", SINGLE_DM_URL, headers=h, json=payload, timeout=10)
+    print(f"send {message['tag']} single:", r.status_code, r.text)
+    return _seatalk_json(r)
 
-def send_card_to_group(token: str, group_id: str, elements: list):
+def send_to_group(token: str, group_id: str, message: dict):
     h = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    payload = {"group_id": group_id,
-               "message": {"tag": "interactive_message", "interactive_message": {"elements": elements}}}
-    r = requests.post(GROUP_DM_URL, headers=h, json=payload, timeout=10)
-    print("send group:", group_id, r.status_code, r.text)
-    r.raise_for_status()
-    return r.json()
+    payload = {"group_id": group_id, "message": message}
+    r = _post("group_chat", GROUP_DM_URL, headers=h, json=payload, timeout=10)
+    print(f"send {message['tag']} group:", group_id, r.status_code, r.text)
+    return _seatalk_json(r)
+
+def send_card_to_employee(token: str, employee_code: str, elements: list):
+    return send_to_employee(token, employee_code, card_message(elements))
+
+def send_card_to_group(token: str, group_id: str, elements: list):
+    return send_to_group(token, group_id, card_message(elements))
 
 def send_text_to_employee(token: str, employee_code: str, text: str):
-    h = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    payload = {"employee_code": employee_code, "message": {"tag": "text", "text": {"content": text}}}
-    r = requests.post(SINGLE_DM_URL, headers=h, json=payload, timeout=10)
-    print("send text single:", r.status_code, r.text)
-    r.raise_for_status()
-    return r.json()
+    return send_to_employee(token, employee_code, text_message(text))
 
 def send_text_to_group(token: str, group_id: str, text: str):
-    h = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    payload = {"group_id": group_id, "message": {"tag": "text", "text": {"content": text}}}
-    r = requests.post(GROUP_DM_URL, headers=h, json=payload, timeout=10)
-    print("send text group:", group_id, r.status_code, r.text)
-    r.raise_for_status()
-    return r.json()
+    return send_to_group(token, group_id, text_message(text))
+
+# ========= Background (trabalho adiado do /callback) =========
+_bg_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="bg")
+_bg_stats = {"deferred": 0, "pending": 0}
+_bg_lock = threading.Lock()
+
+def _bg_job(name: str, fn):
+    try:
+        fn()
+    except Exception as e:
+        print(f"{name} error:", repr(e))
+    finally:
+        with _bg_lock:
+            _bg_stats["pending"] -= 1
+
+def _run_within_deadline(deadline: float, steps: dict):
+    """
+    Dispara os passos em paralelo no pool e espera só até o deadline.
+    Os que não terminarem continuam em background (com os timeouts próprios)
+    em vez de segurar a resposta.
+    """
+    with _bg_lock:
+        _bg_stats["pending"] += len(steps)
+    # copy_context: os spans dos passos entram no Server-Timing da requisição
+    futs = [_bg_executor.submit(contextvars.copy_context().run, _bg_job, name, fn) for name, fn in steps.items()]
+    _, pending = wait(futs, timeout=max(0.0, deadline - time.monotonic()))
+    if pending:
+        with _bg_lock:
+            _bg_stats["deferred"] += len(pending)
+        print(f"callback deadline: {len(pending)} passo(s) adiado(s) p/ background")
+
+# ========= Timing por requisição (Server-Timing) =========
+_timings = contextvars.ContextVar("timings", default=None)
+
+@contextmanager
+def _span(name: str):
+    """Soma a duração (ms) na fase `name` da requisição atual; fora de requisição não faz nada."""
+    t = _timings.get()
+    if t is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        t[name] = t.get(name, 0.0) + (time.perf_counter() - t0) * 1000
+
+@app.before_request
+def _start_timing():
+    g.t0 = time.perf_counter()
+    _timings.set({})
+
+@app.after_request
+def _server_timing(resp):
+    t = _timings.get()
+    if t is None or "t0" not in g:
+        return resp
+    total = (time.perf_counter() - g.t0) * 1000
+    spans = dict(t)
+    resp.headers["Server-Timing"] = ", ".join(
+        [f"{k};dur={v:.1f}" for k, v in spans.items()] + [f"total;dur={total:.1f}"])
+    if SLOW_REQUEST_MS and total >= SLOW_REQUEST_MS:
+        print(f"slow request: {request.method} {request.path} {resp.status_code} {total:.0f} ms",
+              {k: round(v, 1) for k, v in spans.items()})
+    return resp
+
+# ========= Admission control (load shedding) =========
+_admission = {cls: {"inflight": 0, "shed": 0} for cls in MAX_INFLIGHT}
+_admission_lock = threading.Lock()
+
+def _route_class():
+    p = request.path
+    if p == "/callback" or (p == "/" and request.method == "POST"):
+        return "callback"
+    if p.startswith("/api/") or p.startswith("/test/"):
+        return "send"
+    if p == "/ui":
+        return "ui"
+    return None  # health (GET /) e /status nunca são limitados
+
+@app.before_request
+def _admit():
+    cls = _route_class()
+    if not cls:
+        return None
+    with _admission_lock:
+        slot = _admission[cls]
+        full = slot["inflight"] >= MAX_INFLIGHT[cls]
+        if cls == "callback" and _bg_stats["pending"] >= BACKGROUND_MAX_PENDING:
+            full = True  # background já está atrasado; não aceita mais trabalho
+        if full:
+            slot["shed"] += 1
+        else:
+            slot["inflight"] += 1
+    if full:
+        # callback: 503 (SeaTalk reenvia); APIs/UI: 429 para o operador tentar de novo
+        code = 503 if cls == "callback" else 429
+        return jsonify({"error": "sobrecarga, tente novamente"}), code, {"Retry-After": str(RETRY_AFTER_SEC)}
+    g.admitted = cls
+    return None
+
+@app.teardown_request
+def _release(exc):
+    cls = g.pop("admitted", None)
+    if cls:
+        with _admission_lock:
+            _admission[cls]["inflight"] -= 1
 
 # ========= Health =========
 @app.get("/")
 def health():
     return "ok", 200
 
+@app.get("/ready")
+def ready():
+    """Readiness (separado do liveness em GET /): 200 só depois do warm-up."""
+    return jsonify(_ready_snapshot()), (200 if _warmup["done"] else 503)
+
+def _ready_snapshot() -> dict:
+    return {
+        "ready": _warmup["done"],
+        "steps": _warmup["steps"],
+        "warmup_sec": _warmup["warmup_sec"],
+        "first_fast_callback_sec": _warmup["first_fast_callback_sec"],
+    }
+
+@app.get("/status")
+def status():
+    """Estado dos circuit breakers para monitoramento."""
+    return jsonify(_status_snapshot()), 200
+
+def _status_snapshot() -> dict:
+    with _retry_lock:
+        retry = dict(_retry_budget)
+    with _sched_cond:  # o scheduler e /api/schedules alteram _sched_jobs sob este lock
+        jobs = len(_sched_jobs)
+        next_run = min((j["run_at"] for j in _sched_jobs.values()
+                        if j["enabled"] and j["run_at"] is not None), default=None)
+    return {
+        "breakers": {n: b.snapshot() for n, b in _breakers.items()},
+        "retry_budget": retry,
+        "callback": {"deadline_sec": CALLBACK_DEADLINE_SEC, **_bg_stats},
+        "admission": {cls: {"limit": MAX_INFLIGHT[cls], **v} for cls, v in _admission.items()},
+        "json_codec": JSON_CODEC,
+        "scheduler": {"jobs": jobs, "next_run_at": next_run},
+    }
+
 # ========= Callback oficial =========
 @app.post("/callback")
 def seatalk_callback():
-    raw = request.get_data()
-    data = request.get_json(force=True)
+    t0 = time.monotonic()
+    deadline = t0 + CALLBACK_DEADLINE_SEC
+    raw = request.get_data()  # buffer único: usado no parse e na assinatura
+    with _span("parse"):
+        try:
+            data = _json_loads(raw)
+        except Exception:
+            return "invalid json", 400
+    if not isinstance(data, dict):
+        return "invalid json", 400
     etype = str(data.get("event_type", ""))
     sig   = request.headers.get("Signature") or request.headers.get("signature") or ""
 
@@ -261,33 +638,31 @@ def seatalk_callback():
 
     # Assinatura (opcional)
     if SEATALK_SIGNING_SECRET:
-        calc = expected_signature(raw)
-        if not sig or calc.lower() != sig.lower():
-            print("signature mismatch", sig, calc)
-            # return "unauthorized", 403
+        with _span("sig"):
+            sig_ok = signature_matches(raw, sig)
+        # if not sig_ok: return "unauthorized", 403
 
     # Clique em card
     if etype == "interactive_message_click":
         evt        = data.get("event") or {}
         message_id = str(evt.get("message_id", ""))
-        value      = evt.get("value")
+        value      = _decode_value(evt.get("value"))  # decodificado uma vez p/ action e meta
         action     = _extract_action(value)  # apenas para log
         meta       = _extract_sheet_meta(value)  # sheet_id/sheet_name enviados no botão
         email_or_id= str(evt.get("email") or evt.get("seatalk_id") or "")
         group_id   = str(evt.get("group_id") or evt.get("chat_id") or "")
 
+        ts_iso = datetime.now(timezone.utc).isoformat()
+
         # Log Sheets (não bloqueia)
-        try:
-            ts_iso = datetime.now(timezone.utc).isoformat()
+        def _log_click():
             _append_click_row(
                 ts_iso, email_or_id, action, message_id, group_id,
                 sheet_id=meta.get("sheet_id"), sheet_name=meta.get("sheet_name")
             )
-        except Exception as e:
-            print("sheets log error:", repr(e))
 
         # NÃO atualiza o card. Apenas envia a mensagem "Resposta enviada".
-        try:
+        def _send_thanks():
             token = get_token()
             thank_msg = "Resposta enviada"
             if group_id:
@@ -299,9 +674,9 @@ def seatalk_callback():
                 send_text_to_employee(token, emp_code, thank_msg)
             else:
                 print("no direct target to thank (missing group_id/email)")
-        except Exception as e:
-            print("send thank text error:", repr(e))
 
+        _run_within_deadline(deadline, {"sheets log": _log_click, "send thank text": _send_thanks})
+        _note_callback_latency(time.monotonic() - t0)
         return "ok", 200
 
     return "ok", 200
@@ -312,9 +687,9 @@ def seatalk_callback_root():
     return seatalk_callback()
 
 # ========= UI (SEM f-string) =========
-@app.get("/ui")
-def ui_send():
-    html = """
+UI_CACHE_MAX_AGE = int(os.getenv("UI_CACHE_MAX_AGE") or "86400")
+
+_UI_HTML = """
 <!doctype html>
 <html lang="pt-br">
 <head>
@@ -662,7 +1037,58 @@ async function enviarTextoGrp() {
 </body>
 </html>
     """
-    return html, 200, {"Content-Type": "text/html; charset=utf-8"}
+
+def _build_ui_assets(html: str) -> dict:
+    """Pré-computa (uma vez, no import) as variantes comprimidas da UI e ETags fortes."""
+    raw = html.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    assets = {"identity": (raw, f'"{digest}"')}
+    assets["gzip"] = (gzip.compress(raw, compresslevel=9, mtime=0), f'"{digest}-gz"')
+    if brotli is not None:
+        assets["br"] = (brotli.compress(raw, quality=11), f'"{digest}-br"')
+    return assets
+
+_ui_assets = _build_ui_assets(_UI_HTML)
+
+def _accepted_encodings(header: str) -> set:
+    out = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            out.add(name.strip().lower())
+    return out
+
+def _ui_response(accept_encoding: str, if_none_match: str):
+    """(corpo, status, headers) da UI; compartilhado com o modo ASGI."""
+    accepted = _accepted_encodings(accept_encoding)
+    enc = next((e for e in ("br", "gzip") if e in _ui_assets and e in accepted), "identity")
+    body, etag = _ui_assets[enc]
+    headers = {
+        "Content-Type": "text/html; charset=utf-8",
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={UI_CACHE_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+    }
+    if enc != "identity":
+        headers["Content-Encoding"] = enc
+
+    # comparação fraca (RFC 9110): proxies/CDNs costumam devolver W/"..."
+    tags = [t.strip().removeprefix("W/") for t in (if_none_match or "").split(",")]
+    if "*" in tags or etag in tags:
+        headers.pop("Content-Type")
+        return b"", 304, headers
+    return body, 200, headers
+
+@app.get("/ui")
+def ui_send():
+    return _ui_response(request.headers.get("Accept-Encoding", ""), request.headers.get("If-None-Match", ""))
 
 # ========= Auth da UI =========
 def _check_ui_auth():
@@ -674,187 +1100,600 @@ def _check_ui_auth():
     return None
 
 # ========= APIs de envio =========
-@app.post("/api/send-interactive")
-def api_send_interactive():
+_SEND_FIELD = {"interactive": "email", "group-interactive": "group_id", "group-redirect": "group_id",
+               "text": "email", "group-text": "group_id"}
+_NO_TARGET  = {"email": "informe pelo menos um e-mail", "group_id": "informe pelo menos um group_id"}
+
+def _list_param(p, key: str) -> list:
+    """buttons/redirects chegam como string JSON (form/query) ou lista (JSON/agendamento)."""
+    v = p.get(key) or []
+    return json.loads(v) if isinstance(v, str) else list(v)
+
+def _send_message(kind: str, p) -> tuple:
+    """
+    Valida os parâmetros de um tipo de envio e monta (campo, message). Única fonte
+    de defaults e validação para /api/send-*, /api/send-bulk, agendamentos e o
+    modo ASGI. ValueError = parâmetros inválidos (400).
+    """
+    field = _SEND_FIELD.get(kind)
+    if not field:
+        raise ValueError(f"tipo de envio desconhecido: {kind}")
+    if kind in ("interactive", "group-interactive"):
+        title = (p.get("title") or "📌 Confirme sua leitura").strip()
+        desc  = (p.get("desc")  or "Escolha uma das opções abaixo.").strip()
+        meta  = {"sheet_id": (p.get("sheet_id") or "").strip(), "sheet_name": (p.get("sheet_name") or "").strip()}
+        return field, card_message(build_elements(title, desc, _list_param(p, "buttons"), meta=meta))
+    if kind == "group-redirect":
+        title = (p.get("title") or "🔗 Ações rápidas").strip()
+        desc  = (p.get("desc")  or "Escolha um dos links abaixo para abrir.").strip()
+        # Valida URLs básicas
+        valids = []
+        for r in _list_param(p, "redirects")[:3]:
+            t = str(r.get("text") or "").strip()
+            u = str(r.get("url") or "").strip()
+            if t and _is_http_url(u):
+                valids.append({"text": t, "url": u})
+        if not valids:
+            raise ValueError("informe ao menos 1 botão com URL http(s) válida")
+        return field, card_message(build_redirect_elements(title, desc, valids))
+    text = (p.get("text") or "").strip()
+    if not text:
+        raise ValueError("texto é obrigatório")
+    return field, text_message(text)
+
+def _send_request(kind: str, body: dict) -> tuple:
+    """Corpo de /api/send-*: (campo, destinos, message); destinos são validados antes do conteúdo."""
+    field = _SEND_FIELD[kind]
+    targets = _target_list(body.get("emails" if field == "email" else "group_ids"))
+    if not targets:
+        raise ValueError(_NO_TARGET[field])
+    return field, targets, _send_message(kind, body)[1]
+
+def _to_employee(message: dict):
+    def _send(em, st):
+        emp_code = _call_with_retry(lambda tk: resolve_employee_code(tk, em), st, idempotent=True)
+        return _call_with_retry(lambda tk: send_to_employee(tk, emp_code, message), st)
+    return _send
+
+def _to_group(message: dict):
+    return lambda gid, st: _call_with_retry(lambda tk: send_to_group(tk, gid, message), st)
+
+def _sender(kind: str, p) -> tuple:
+    """(campo, fn(destinatário, stats)) para o tipo de envio. ValueError = parâmetros inválidos (400)."""
+    field, message = _send_message(kind, p)
+    return field, (_to_employee if field == "email" else _to_group)(message)
+
+def _send_api(kind: str):
     auth_resp = _check_ui_auth()
     if auth_resp:
         return auth_resp
     try:
         body = request.get_json(force=True) or {}
-        emails  = body.get("emails") or []
-        title   = (body.get("title") or "📌 Confirme sua leitura").strip()
-        desc    = (body.get("desc")  or "Escolha uma das opções abaixo.").strip()
-        buttons = body.get("buttons") or []
-        sheet_id   = (body.get("sheet_id") or "").strip()
-        sheet_name = (body.get("sheet_name") or "").strip()
-
-        if isinstance(emails, str):
-            emails = [s.strip() for s in emails.replace(",", "\n").split("\n") if s.strip()]
-        else:
-            emails = [str(x).strip() for x in emails if str(x).strip()]
-        if not emails:
-            return jsonify({"error":"informe pelo menos um e-mail"}), 400
+        try:
+            field, targets, message = _send_request(kind, body)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        send = (_to_employee if field == "email" else _to_group)(message)
 
-        token = get_token()
-        meta  = {"sheet_id": sheet_id, "sheet_name": sheet_name}
-        elements = build_elements(title, desc, buttons, meta=meta)
+        get_token()  # falha cedo se a autenticação estiver indisponível
         results = []
-
-        for em in emails:
+        for t in targets:
+            st = {"attempts": 0}
             try:
-                emp_code = resolve_employee_code(token, em)
-                rj = send_card_to_employee(token, emp_code, elements)
-                results.append({"email": em, "ok": True, "resp": rj})
+                rj = send(t, st)
+                results.append({field: t, "ok": True, "resp": rj, "attempts": st["attempts"]})
             except Exception as e:
-                results.append({"email": em, "ok": False, "error": str(e)})
+                results.append({field: t, "ok": False, "error": str(e), "attempts": st["attempts"]})
 
         return jsonify({"sent": results}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.post("/api/send-interactive")
+def api_send_interactive():
+    return _send_api("interactive")
+
 @app.post("/api/send-group-interactive")
 def api_send_group_interactive():
+    return _send_api("group-interactive")
+
+@app.post("/api/send-group-redirect")
+def api_send_group_redirect():
+    return _send_api("group-redirect")
+
+@app.post("/api/send-text")
+def api_send_text():
+    return _send_api("text")
+
+@app.post("/api/send-group-text")
+def api_send_group_text():
+    return _send_api("group-text")
+
+# ========= Envio em massa (arquivo de destinatários) =========
+RECIPIENT_LINE_MAX = 64 * 1024
+RECIPIENT_CHUNK    = 64 * 1024
+_EMAIL_RE    = re.compile(r"^[^@\s,;]+@[^@\s,;]+\.[^@\s,;]+$")
+_GROUP_ID_RE = re.compile(r"^[A-Za-z0-9+/=_-]{4,128}$")
+_HEADER_NAMES = {"email": {"email", "e-mail", "emails"}, "group_id": {"group_id", "group_ids", "groupid"}}
+
+def _stream_lines(stream):
+    """Linhas do corpo cru (text/csv), lidas sob demanda."""
+    return iter(lambda: stream.readline(RECIPIENT_LINE_MAX), b"")
+
+def _chunk_lines(chunks):
+    """Reagrupa em linhas os pedaços do arquivo que chegam do multipart."""
+    buf = b""
+    for chunk in chunks:
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        yield from lines
+        while len(buf) > RECIPIENT_LINE_MAX:
+            yield buf[:RECIPIENT_LINE_MAX]
+            buf = buf[RECIPIENT_LINE_MAX:]
+    if buf:
+        yield buf
+
+def _multipart_events(stream, boundary: bytes):
+    """Eventos do decoder multipart do Werkzeug, alimentado aos poucos (sem o spool de request.files)."""
+    dec = MultipartDecoder(boundary, max_parts=100)
+    while True:
+        ev = dec.next_event()
+        if isinstance(ev, NeedData):
+            dec.receive_data(stream.read(RECIPIENT_CHUNK) or None)  # corpo truncado -> ValueError
+        elif isinstance(ev, Epilogue):
+            return
+        else:
+            yield ev
+
+def _part_data(events):
+    """Bytes da parte atual, até o fim dela."""
+    for ev in events:
+        if not isinstance(ev, Data):
+            return
+        yield ev.data
+        if not ev.more_data:
+            return
+
+def _multipart_recipients(stream, boundary: bytes) -> tuple:
+    """
+    Lê o multipart/form-data até o arquivo "recipients": devolve (campos do form
+    que vieram antes dele, linhas do arquivo sob demanda) ou (campos, None).
+    """
+    events = _multipart_events(stream, boundary)
+    fields, name, buf = {}, None, b""
+    for ev in events:
+        if isinstance(ev, File):
+            if ev.name == "recipients":
+                return fields, _chunk_lines(_part_data(events))
+            name = None  # outros arquivos são ignorados
+        elif isinstance(ev, Field):
+            name, buf = ev.name, b""
+        elif isinstance(ev, Data) and name is not None:
+            buf += ev.data
+            if len(buf) > RECIPIENT_LINE_MAX:
+                raise ValueError(f"campo {name} grande demais")
+            if not ev.more_data:
+                fields[name] = buf.decode("utf-8", "replace")
+    return fields, None
+
+def _recipient_rows(lines, field: str, column: str = "") -> tuple:
+    """
+    Uma coluna por linha de CSV. `column` escolhe a coluna pelo nome no cabeçalho;
+    sem ele, usa a coluna cujo cabeçalho é e-mail/group_id ou, se não houver
+    cabeçalho, a primeira. Devolve (índice, linhas de dados); ValueError se a
+    coluna pedida não existir.
+    """
+    rows = csv.reader(line.decode("utf-8", "replace") for line in lines)
+    first = next(rows, [])
+    head = [c.strip().lstrip("\ufeff").strip('"').strip().lower() for c in first]
+    column = (column or "").strip().lower()
+    if column:
+        if column not in head:
+            raise ValueError(f"coluna '{column}' não encontrada no cabeçalho")
+        return head.index(column), rows
+    idx = next((i for i, c in enumerate(head) if c in _HEADER_NAMES[field]), None)
+    if idx is not None:
+        return idx, rows
+    return 0, itertools.chain([first], rows)
+
+def _iter_recipients(idx: int, rows):
+    for row in rows:
+        cell = row[idx].strip() if idx < len(row) else ""
+        if cell:
+            yield cell
+
+@app.post("/api/send-bulk/<kind>")
+def api_send_bulk(kind):
+    """
+    Envio para listas grandes. Destinatários vêm no campo de arquivo "recipients"
+    (multipart/form-data, demais parâmetros como campos do form) ou no corpo cru
+    (text/csv ou text/plain, parâmetros na query string). kind segue as rotas
+    /api/send-*: interactive, group-interactive, group-redirect, text, group-text.
+
+    O arquivo é um CSV com um destinatário por linha: vale uma única coluna
+    (parâmetro "column" = nome no cabeçalho; senão a coluna email/group_id do
+    cabeçalho ou a primeira), e a linha de cabeçalho é pulada. No multipart, os
+    campos do form precisam vir antes do arquivo (ou ir na query string).
+
+    Nos dois formatos o corpo é lido incrementalmente e cada destinatário é
+    enviado assim que chega; a resposta é NDJSON (uma linha por destinatário +
+    resumo final).
+    """
     auth_resp = _check_ui_auth()
     if auth_resp:
         return auth_resp
     try:
-        body = request.get_json(force=True) or {}
-        group_ids = body.get("group_ids") or []
-        title   = (body.get("title") or "📌 Confirme sua leitura").strip()
-        desc    = (body.get("desc")  or "Escolha uma das opções abaixo.").strip()
-        buttons = body.get("buttons") or []
-        sheet_id   = (body.get("sheet_id") or "").strip()
-        sheet_name = (body.get("sheet_name") or "").strip()
-
-        if isinstance(group_ids, str):
-            group_ids = [s.strip() for s in group_ids.replace(",", "\n").split("\n") if s.strip()]
+        if request.mimetype == "multipart/form-data":
+            boundary = request.mimetype_params.get("boundary", "").encode()
+            if not boundary:
+                return jsonify({"error": "multipart sem boundary"}), 400
+            form, lines = _multipart_recipients(request.stream, boundary)
+            if lines is None:
+                return jsonify({"error": "envie o arquivo no campo 'recipients'"}), 400
+            params = {**request.args.to_dict(), **form}
         else:
-            group_ids = [str(x).strip() for x in group_ids if str(x).strip()]
-        if not group_ids:
-            return jsonify({"error":"informe pelo menos um group_id"}), 400
-
-        token = get_token()
-        meta  = {"sheet_id": sheet_id, "sheet_name": sheet_name}
-        elements = build_elements(title, desc, buttons, meta=meta)
-        results = []
+            params, lines = request.args, _stream_lines(request.stream)
+        field, send = _sender(kind, params)
+        idx, rows = _recipient_rows(lines, field, params.get("column"))
+        get_token()  # falha cedo se a autenticação estiver indisponível
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    valid = _EMAIL_RE if field == "email" else _GROUP_ID_RE
 
-        for gid in group_ids:
+    def _generate():
+        seen = set()  # hashes de 8 bytes em vez das strings completas
+        summary = {"done": True, "ok": 0, "failed": 0, "invalid": 0, "duplicates": 0}
+        try:
+            for rcpt in _iter_recipients(idx, rows):
+                if not valid.match(rcpt):
+                    summary["invalid"] += 1
+                    yield _json_dumps({field: rcpt, "ok": False, "error": "inválido"}) + b"\n"
+                    continue
+                # e-mail não diferencia maiúsculas; group_id (base64) diferencia
+                key = hashlib.blake2b((rcpt.lower() if field == "email" else rcpt).encode(), digest_size=8).digest()
+                if key in seen:
+                    summary["duplicates"] += 1
+                    continue
+                seen.add(key)
+                st = {"attempts": 0}
+                try:
+                    rj = send(rcpt, st)
+                    summary["ok"] += 1
+                    out = {field: rcpt, "ok": True, "resp": rj, "attempts": st["attempts"]}
+                except Exception as e:
+                    summary["failed"] += 1
+                    out = {field: rcpt, "ok": False, "error": str(e), "attempts": st["attempts"]}
+                yield _json_dumps(out) + b"\n"
+        except (ValueError, csv.Error) as e:
+            # corpo truncado/malformado no meio do envio: o que já foi enviado fica no resumo
+            summary["error"] = str(e)
+        yield _json_dumps(summary) + b"\n"
+
+    return Response(stream_with_context(_generate()), mimetype="application/x-ndjson")
+
+# ========= Agendamentos (scheduler) =========
+# No Render free (render.yaml) o disco é efêmero: redeploy/restart/hibernação apagam
+# o scheduler.db. Para os jobs sobreviverem, aponte SCHEDULER_DB para um disco persistente.
+SCHEDULER_DB        = os.getenv("SCHEDULER_DB") or "scheduler.db"
+SCHEDULER_TZ        = ZoneInfo(os.getenv("SCHEDULER_TZ") or "America/Sao_Paulo")
+SCHEDULER_GRACE_SEC = float(os.getenv("SCHEDULER_GRACE_SEC") or "3600")  # atraso máximo p/ ainda rodar após restart
+
+def _cron_field(spec: str, lo: int, hi: int) -> set:
+    out = set()
+    for part in spec.split(","):
+        rng, _, step = part.partition("/")
+        if rng == "*":
+            a, b = lo, hi
+        elif "-" in rng:
+            a, b = (int(x) for x in rng.split("-", 1))
+        else:
+            a = b = int(rng)
+            if step:
+                b = hi
+        if a < lo or b > hi or a > b:
+            raise ValueError(f"cron fora do intervalo: {spec}")
+        out.update(range(a, b + 1, int(step or 1)))
+    return out
+
+def _parse_cron(expr: str) -> tuple:
+    """Cron de 5 campos (min hora dia mês dia-da-semana); domingo = 0 ou 7."""
+    parts = (expr or "").split()
+    if len(parts) != 5:
+        raise ValueError("cron deve ter 5 campos: min hora dia mês dia-da-semana")
+    minute, hour, dom, month = (_cron_field(p, lo, hi) for p, (lo, hi) in
+                                zip(parts[:4], ((0, 59), (0, 23), (1, 31), (1, 12))))
+    dow = {d % 7 for d in _cron_field(parts[4], 0, 7)}
+    return minute, hour, dom, month, dow, parts[2] == "*", parts[4] == "*"
+
+def _cron_next(expr: str, after: float) -> float:
+    """Próxima execução (epoch) estritamente depois de `after`, no fuso SCHEDULER_TZ."""
+    minute, hour, dom, month, dow, dom_any, dow_any = _parse_cron(expr)
+    t = datetime.fromtimestamp(after, SCHEDULER_TZ).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 5)
+    while t < limit:
+        if t.month not in month:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            continue
+        # semântica cron: se dia e dia-da-semana são restritos, basta um casar
+        d_ok, w_ok = t.day in dom, (t.weekday() + 1) % 7 in dow
+        if not ((d_ok and w_ok) if (dom_any or dow_any) else (d_ok or w_ok)):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if t.hour not in hour:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+        if t.minute not in minute:
+            t += timedelta(minutes=1)
+            continue
+        return t.replace(tzinfo=SCHEDULER_TZ).timestamp()
+    raise ValueError(f"cron sem próxima execução: {expr}")
+
+_sched_jobs = {}    # id -> dict (espelho da tabela)
+_sched_heap = []    # (run_at, id); entradas obsoletas são descartadas ao sair do heap
+_sched_cond = threading.Condition()
+_sched_db = None
+
+def _sched_conn():
+    global _sched_db
+    if _sched_db is None:
+        _sched_db = sqlite3.connect(SCHEDULER_DB, check_same_thread=False)
+        _sched_db.row_factory = sqlite3.Row
+        _sched_db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL, params TEXT NOT NULL, recipients TEXT NOT NULL,
+            run_at REAL, cron TEXT, spread_sec REAL NOT NULL DEFAULT 0,
+            enabled INTEGER NOT NULL DEFAULT 1, last_run REAL, last_result TEXT)""")
+        _sched_db.commit()
+    return _sched_db
+
+def _sched_save(job: dict):
+    """Persiste run_at/enabled/last_* (chamar com _sched_cond adquirido)."""
+    db = _sched_conn()
+    db.execute("UPDATE jobs SET run_at=?, enabled=?, last_run=?, last_result=? WHERE id=?",
+               (job["run_at"], job["enabled"], job["last_run"], job["last_result"], job["id"]))
+    db.commit()
+
+def _sched_push(job: dict):
+    _sched_jobs[job["id"]] = job
+    if job["enabled"] and job["run_at"] is not None:
+        heapq.heappush(_sched_heap, (job["run_at"], job["id"]))
+    _sched_cond.notify()
+
+def _sched_run(job: dict):
+    """Executa um disparo, espalhando os envios em spread_sec para suavizar a taxa."""
+    summary = {"ok": 0, "failed": 0}
+    try:
+        field, send = _sender(job["kind"], job["params"])
+        rcpts = job["recipients"]
+        gap = job["spread_sec"] / len(rcpts) if rcpts and job["spread_sec"] > 0 else 0
+        for i, rcpt in enumerate(rcpts):
+            if gap and i:
+                time.sleep(gap)
             try:
-                rj = send_card_to_group(token, gid, elements)
-                results.append({"group_id": gid, "ok": True, "resp": rj})
+                send(rcpt, {"attempts": 0})
+                summary["ok"] += 1
             except Exception as e:
-                results.append({"group_id": gid, "ok": False, "error": str(e)})
-
-        return jsonify({"sent": results}), 200
+                summary["failed"] += 1
+                print(f"schedule {job['id']} {field} {rcpt} error:", repr(e))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.post("/api/send-group-redirect")
-def api_send_group_redirect():
-    auth_resp = _check_ui_auth()
-    if auth_resp:
-        return auth_resp
+        summary["error"] = str(e)
+    print(f"schedule {job['id']} done:", summary)
+    with _sched_cond:
+        job["last_result"] = json.dumps(summary, ensure_ascii=False)
+        _sched_save(job)
+
+def _sched_disable(job: dict, e: Exception):
+    """Job que não dá para avançar (cron sem próxima execução, JSON corrompido): desativa em vez de derrubar o scheduler."""
+    print(f"schedule {job['id']} disabled:", repr(e))
+    job["enabled"] = 0
+    job["last_result"] = json.dumps({"error": str(e)}, ensure_ascii=False)
     try:
-        body = request.get_json(force=True) or {}
-        group_ids = body.get("group_ids") or []
-        title   = (body.get("title") or "🔗 Ações rápidas").strip()
-        desc    = (body.get("desc")  or "Escolha um dos links abaixo para abrir.").strip()
-        redirects = body.get("redirects") or []
-
-        if isinstance(group_ids, str):
-            group_ids = [s.strip() for s in group_ids.replace(",", "\n").split("\n") if s.strip()]
-        else:
-            group_ids = [str(x).strip() for x in group_ids if str(x).strip()]
-        if not group_ids:
-            return jsonify({"error":"informe pelo menos um group_id"}), 400
-
-        # Valida URLs básicas
-        valids = []
-        for r in redirects[:3]:
-            t = str(r.get("text") or "").strip()
-            u = str(r.get("url") or "").strip()
-            if t and _is_http_url(u):
-                valids.append({"text": t, "url": u})
-        if not valids:
-            return jsonify({"error":"informe ao menos 1 botão com URL http(s) válida"}), 400
-
-        token = get_token()
-        elements = build_redirect_elements(title, desc, valids)
-        results = []
-
-        for gid in group_ids:
+        _sched_save(job)
+    except Exception as e2:
+        print(f"schedule {job['id']} save error:", repr(e2))
+
+def _sched_due(job: dict, now: float):
+    """Avança/desativa o job ANTES de enviar: um restart no meio não repete o disparo."""
+    job["last_run"] = now
+    job["run_at"] = _cron_next(job["cron"], now) if job["cron"] else None
+    job["enabled"] = 1 if job["cron"] else 0
+    _sched_save(job)
+    _sched_push(job)
+    threading.Thread(target=_sched_run, args=(job,), daemon=True).start()
+
+def _start_scheduler_thread():
+    """Carrega os jobs do SQLite e dorme até o próximo vencimento (sem polling)."""
+    now = time.time()
+    with _sched_cond:
+        for row in _sched_conn().execute("SELECT * FROM jobs WHERE enabled=1"):
+            job = dict(row)
             try:
-                rj = send_card_to_group(token, gid, elements)
-                results.append({"group_id": gid, "ok": True, "resp": rj})
+                job["params"], job["recipients"] = json.loads(job["params"]), json.loads(job["recipients"])
+                if job["run_at"] is not None and job["run_at"] < now - SCHEDULER_GRACE_SEC:
+                    # perdido enquanto o serviço estava fora há tempo demais: pula
+                    job["run_at"] = _cron_next(job["cron"], now) if job["cron"] else None
+                    job["enabled"] = 1 if job["cron"] else 0
+                    job["last_result"] = json.dumps({"skipped": "missed"})
+                    _sched_save(job)
             except Exception as e:
-                results.append({"group_id": gid, "ok": False, "error": str(e)})
+                _sched_disable(job, e)
+            _sched_push(job)
 
-        return jsonify({"sent": results}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    def _worker():
+        with _sched_cond:
+            while True:
+                if not _sched_heap:
+                    _sched_cond.wait()
+                    continue
+                run_at, jid = _sched_heap[0]
+                job = _sched_jobs.get(jid)
+                if not job or not job["enabled"] or job["run_at"] != run_at:
+                    heapq.heappop(_sched_heap)
+                    continue
+                delay = run_at - time.time()
+                if delay > 0:
+                    _sched_cond.wait(timeout=delay)
+                    continue
+                heapq.heappop(_sched_heap)
+                try:
+                    _sched_due(job, time.time())
+                except Exception as e:
+                    _sched_disable(job, e)
+
+    threading.Thread(target=_worker, daemon=True).start()
+    print(f"scheduler enabled: {len(_sched_jobs)} job(s) em {SCHEDULER_DB}")
+
+def _parse_run_at(v) -> float:
+    if isinstance(v, (int, float)):
+        return float(v)
+    dt = datetime.fromisoformat(str(v).strip())
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=SCHEDULER_TZ)
+    return dt.timestamp()
+
+def _job_view(job: dict) -> dict:
+    out = {k: job[k] for k in ("id", "kind", "params", "cron", "spread_sec", "enabled", "run_at", "last_run")}
+    out["recipients"] = len(job["recipients"])
+    out["last_result"] = json.loads(job["last_result"]) if job["last_result"] else None
+    return out
+
+@app.post("/api/schedules")
+def api_create_schedule():
+    """
+    Agenda um disparo único (run_at: ISO 8601 ou epoch) ou recorrente (cron de 5
+    campos, fuso SCHEDULER_TZ). kind/params seguem /api/send-bulk; spread_sec
+    distribui os envios ao longo da janela.
 
-@app.post("/api/send-text")
-def api_send_text():
+    Os jobs ficam em SCHEDULER_DB (SQLite) e sobrevivem a restarts apenas se o
+    arquivo estiver em disco persistente; no Render free ele é apagado a cada
+    redeploy/restart/hibernação, junto com todos os agendamentos.
+    """
     auth_resp = _check_ui_auth()
     if auth_resp:
         return auth_resp
     try:
         body = request.get_json(force=True) or {}
-        emails = body.get("emails") or []
-        text   = (body.get("text") or "").strip()
-
-        if isinstance(emails, str):
-            emails = [s.strip() for s in emails.replace(",", "\n").split("\n") if s.strip()]
-        else:
-            emails = [str(x).strip() for x in emails if str(x).strip()]
-        if not emails:
-            return jsonify({"error": "informe pelo menos um e-mail"}), 400
-        if not text:
-            return jsonify({"error": "texto é obrigatório"}), 400
-
-        token = get_token()
-        results = []
-        for em in emails:
-            try:
-                emp_code = resolve_employee_code(token, em)
-                rj = send_text_to_employee(token, emp_code, text)
-                results.append({"email": em, "ok": True, "resp": rj})
-            except Exception as e:
-                results.append({"email": em, "ok": False, "error": str(e)})
-        return jsonify({"sent": results}), 200
+        kind   = str(body.get("kind") or "").strip()
+        params = body.get("params") or {}
+        cron   = (body.get("cron") or "").strip() or None
+        spread = float(body.get("spread_sec") or 0)
+        field, _ = _send_message(kind, params)
+        valid = _EMAIL_RE if field == "email" else _GROUP_ID_RE
+
+        rcpts = body.get("recipients") or []
+        if isinstance(rcpts, str):
+            rcpts = rcpts.replace(",", "\n").split("\n")
+        rcpts = list(dict.fromkeys(str(x).strip() for x in rcpts if str(x).strip()))
+        bad = [x for x in rcpts if not valid.match(x)]
+        if bad:
+            return jsonify({"error": f"{field} inválido(s)", "invalid": bad[:20]}), 400
+        if not rcpts:
+            return jsonify({"error": _NO_TARGET[field]}), 400
+
+        if cron:
+            # valida também cron que nunca casa (ex.: "0 0 31 2 *"), mesmo com run_at explícito
+            run_at = _cron_next(cron, time.time())
+        if body.get("run_at") is not None:
+            run_at = _parse_run_at(body["run_at"])
+        elif not cron:
+            return jsonify({"error": "informe run_at ou cron"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.post("/api/send-group-text")
-def api_send_group_text():
+    with _sched_cond:
+        db = _sched_conn()
+        cur = db.execute(
+            "INSERT INTO jobs (kind, params, recipients, run_at, cron, spread_sec) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, json.dumps(params, ensure_ascii=False), json.dumps(rcpts), run_at, cron, spread))
+        db.commit()
+        job = {"id": cur.lastrowid, "kind": kind, "params": params, "recipients": rcpts, "run_at": run_at,
+               "cron": cron, "spread_sec": spread, "enabled": 1, "last_run": None, "last_result": None}
+        _sched_push(job)
+    return jsonify(_job_view(job)), 201
+
+@app.get("/api/schedules")
+def api_list_schedules():
     auth_resp = _check_ui_auth()
     if auth_resp:
         return auth_resp
-    try:
-        body = request.get_json(force=True) or {}
-        group_ids = body.get("group_ids") or []
-        text      = (body.get("text") or "").strip()
+    with _sched_cond:
+        return jsonify({"schedules": [_job_view(j) for j in _sched_jobs.values()]}), 200
 
-        if isinstance(group_ids, str):
-            group_ids = [s.strip() for s in group_ids.replace(",", "\n").split("\n") if s.strip()]
-        else:
-            group_ids = [str(x).strip() for x in group_ids if str(x).strip()]
-        if not group_ids:
-            return jsonify({"error": "informe pelo menos um group_id"}), 400
-        if not text:
-            return jsonify({"error": "texto é obrigatório"}), 400
+@app.delete("/api/schedules/<int:job_id>")
+def api_delete_schedule(job_id):
+    auth_resp = _check_ui_auth()
+    if auth_resp:
+        return auth_resp
+    with _sched_cond:
+        job = _sched_jobs.pop(job_id, None)
+        if not job:
+            return jsonify({"error": "agendamento não encontrado"}), 404
+        db = _sched_conn()
+        db.execute("DELETE FROM jobs WHERE id=?", (job_id,))
+        db.commit()
+        _sched_cond.notify()
+    return jsonify({"deleted": job_id}), 200
+
+# ========= Profiling sob demanda =========
+PROFILE_MAX_SEC = 60
+_profile_lock = threading.Lock()
+
+def _sample_profile(seconds: float, interval: float) -> dict:
+    """Amostra as pilhas de todas as threads (exceto a atual) e agrega por pilha e por função."""
+    me = threading.get_ident()
+    stacks, self_cnt, total_cnt = Counter(), Counter(), Counter()
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            names = []
+            while frame is not None:
+                co = frame.f_code
+                names.append(f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})")
+                frame = frame.f_back
+            if not names:
+                continue
+            names.reverse()
+            stacks[";".join(names)] += 1
+            self_cnt[names[-1]] += 1
+            total_cnt.update(set(names))
+            samples += 1
+        time.sleep(max(0.0, min(interval, end - time.monotonic())))
+    return {
+        "seconds": seconds,
+        "interval_ms": interval * 1000,
+        "samples": samples,
+        "top_functions": [{"func": f, "self": self_cnt[f], "total": n} for f, n in total_cnt.most_common(40)],
+        # formato "collapsed" (flamegraph.pl / speedscope)
+        "stacks": [{"stack": st, "count": n} for st, n in stacks.most_common(200)],
+    }
 
-        token = get_token()
-        results = []
-        for gid in group_ids:
-            try:
-                rj = send_text_to_group(token, gid, text)
-                results.append({"group_id": gid, "ok": True, "resp": rj})
-            except Exception as e:
-                results.append({"group_id": gid, "ok": False, "error": str(e)})
-        return jsonify({"sent": results}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+@app.post("/admin/profile")
+def admin_profile():
+    """Liga o profiler por amostragem por ?seconds=N (máx. 60) e devolve o perfil agregado."""
+    if not UI_ADMIN_TOKEN:
+        # despeja pilhas de todas as threads: nunca fica aberto sem token
+        return jsonify({"error": "defina UI_ADMIN_TOKEN para usar o profiler"}), 403
+    auth_resp = _check_ui_auth()
+    if auth_resp:
+        return auth_resp
+    try:
+        seconds = min(PROFILE_MAX_SEC, max(0.1, float(request.args.get("seconds") or "10")))
+        interval = min(seconds, max(0.001, float(request.args.get("interval_ms") or "5") / 1000))
+    except ValueError:
+        return jsonify({"error": "seconds/interval_ms inválidos"}), 400
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({"error": "profiling já em andamento"}), 409
+    try:
+        return jsonify(_sample_profile(seconds, interval)), 200
+    finally:
+        _profile_lock.release()
 
 # ========= Rota de teste opcional =========
 @app.post("/test/send-interactive-3")
@@ -907,7 +1746,54 @@ def _start_keepalive_thread():
     t.start()
     print(f"keepalive enabled: {url} every {period}s")
 
+# ========= Warm-up no boot =========
+_warmup = {"done": False, "steps": {}, "warmup_sec": None, "first_fast_callback_sec": None}
+
+def _note_callback_latency(elapsed: float):
+    if _warmup["first_fast_callback_sec"] is None and elapsed * 1000 <= FAST_CALLBACK_MS:
+        _warmup["first_fast_callback_sec"] = round(time.monotonic() - _BOOT_TS, 3)
+        print(f"first fast callback: {_warmup['first_fast_callback_sec']}s após o boot ({elapsed*1000:.0f} ms)")
+
+def _start_warmup_thread():
+    """
+    Adianta em background o custo que o primeiro clique pagaria: token SeaTalk
+    (e handshake TLS na sessão compartilhada), imports/credenciais do gspread e
+    abertura da planilha padrão. Não atrasa o bind da porta; /ready reporta o fim.
+    """
+    def _step(name, fn):
+        t = time.monotonic()
+        try:
+            fn()
+            _warmup["steps"][name] = {"ok": True, "ms": round((time.monotonic() - t) * 1000)}
+        except Exception as e:
+            _warmup["steps"][name] = {"ok": False, "ms": round((time.monotonic() - t) * 1000), "error": repr(e)}
+            print(f"warmup {name} error:", repr(e))
+
+    def _sheets():
+        gc = _get_gspread_client()
+        if GOOGLE_SHEET_ID:
+            gc.open_by_key(GOOGLE_SHEET_ID).worksheet(GOOGLE_SHEET_NAME)
+
+    def _worker():
+        if SEATALK_APP_ID and SEATALK_APP_SECRET:
+            _step("token", get_token)
+        if os.getenv("GOOGLE_CREDENTIALS_JSON"):
+            _step("sheets", _sheets)
+        _warmup["warmup_sec"] = round(time.monotonic() - _BOOT_TS, 3)
+        _warmup["done"] = True
+        print(f"warmup done in {_warmup['warmup_sec']}s:", _warmup["steps"])
+
+    threading.Thread(target=_worker, daemon=True).start()
+
 if __name__ == "__main__":
-    _start_keepalive_thread()
     port = int(os.environ.get("PORT", "10000"))
-    app.run(host="0.0.0.0", port=port)
+    # SERVER_MODE=asgi: mesmas rotas principais num event loop (app_async.py).
+    # Lá este arquivo é importado como módulo "app"; as threads de fundo sobem no lifespan dele.
+    if (os.getenv("SERVER_MODE") or "threaded").strip().lower() == "asgi":
+        import uvicorn
+        uvicorn.run("app_async:app", host="0.0.0.0", port=port)
+    else:
+        _start_warmup_thread()
+        _start_scheduler_thread()
+        _start_keepalive_thread()
+        app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,401 @@
+# app_async.py
+"""
+Modo ASGI (opcional): mesmas rotas principais do app.py (/, /callback,
+/api/send-*, /ui, /ready, /status) com I/O não bloqueante — httpx.AsyncClient
+para SeaTalk e API REST do Google Sheets — num único event loop.
+
+Reaproveita do app.py os builders de payload, parse/assinatura do callback,
+circuit breakers, orçamento de retry, codec JSON e assets da UI.
+
+  SERVER_MODE=asgi python app.py      (ou: uvicorn app_async:app)
+
+Envio em massa por arquivo, agendamentos e /admin/profile continuam só no modo
+threaded (o scheduler roda em thread nos dois modos; o warm-up daqui é assíncrono).
+"""
+import os, time, asyncio, random
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import app as core
+from app import (
+    AUTH_URL, CONTACTS_URL, SINGLE_DM_URL, GROUP_DM_URL,
+    SEATALK_SIGNING_SECRET, UI_ADMIN_TOKEN, GOOGLE_SHEET_ID, GOOGLE_SHEET_NAME,
+    CALLBACK_DEADLINE_SEC, SEATALK_TOKEN_ERRORS, RETRY_MAX_ATTEMPTS, RETRY_BASE_SEC, RETRY_MAX_SEC,
+    CircuitOpenError, TokenExpiredError,
+    _breakers, _json_loads, _json_dumps, _decode_value, _extract_action, _extract_sheet_meta,
+    signature_matches, _send_request, text_message, _retry_deposit, _retry_withdraw,
+)
+
+# Quantos destinatários de um mesmo broadcast ficam em voo ao mesmo tempo
+ASYNC_SEND_CONCURRENCY = int(os.getenv("ASYNC_SEND_CONCURRENCY") or "50")
+ASYNC_MAX_CONNECTIONS  = int(os.getenv("ASYNC_MAX_CONNECTIONS") or "200")
+
+SHEETS_API = "https://sheets.googleapis.com/v4/spreadsheets"
+
+_client: httpx.AsyncClient = None
+_background = set()  # passos do callback adiados (referência evita GC da task)
+
+# ========= HTTP (SeaTalk) =========
+async def _post(upstream: str, url: str, payload: dict, token: str = None, timeout: float = 10):
+    br = _breakers[upstream]
+    br.before()
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    try:
+        r = await _client.post(url, content=_json_dumps(payload), headers=headers, timeout=timeout)
+    except httpx.TransportError:
+        br.record(False)
+        raise
+    br.record(r.status_code < 500)
+    return r
+
+def _seatalk_json(r) -> dict:
+    r.raise_for_status()
+    j = _json_loads(r.content)
+    if j.get("code") in SEATALK_TOKEN_ERRORS:
+        raise TokenExpiredError(f"token expirado: {j}")
+    return j
+
+_token_lock = asyncio.Lock()
+
+async def get_token():
+    """Mesmo cache do app.py (core._token); o lock evita várias renovações simultâneas."""
+    if not core.SEATALK_APP_ID or not core.SEATALK_APP_SECRET:
+        raise RuntimeError("SEATALK_APP_ID/SEATALK_APP_SECRET ausentes")
+    tk = core._token
+    if tk["v"] and int(time.time()) < tk["exp"] - 60:
+        return tk["v"]
+    async with _token_lock:
+        now = int(time.time())
+        if tk["v"] and now < tk["exp"] - 60:
+            return tk["v"]
+        r = await _post("auth", AUTH_URL, {"app_id": core.SEATALK_APP_ID, "app_secret": core.SEATALK_APP_SECRET})
+        data = _json_loads(r.content)
+        token = data.get("access_token") or data.get("app_access_token")
+        if not token:
+            raise RuntimeError(f"Falha ao obter token: {data}")
+        tk.update({"v": token, "exp": now + int(data.get("expires_in") or data.get("expire") or 7200)})
+        return token
+
+async def resolve_employee_code(token: str, email: str) -> str:
+    j = _seatalk_json(await _post("contacts", CONTACTS_URL, {"emails": [email]}, token))
+    if j.get("code") != 0 or not j.get("employees"):
+        raise RuntimeError(f"Falha employee_code para {email}: {j}")
+    emp = next((e for e in j["employees"] if e.get("employee_status") == 2), None)
+    if not emp:
+        raise RuntimeError(f"Usuário inativo: {email}")
+    return emp["employee_code"]
+
+async def send_to_employee(token: str, employee_code: str, message: dict):
+    r = await _post("single_chat", SINGLE_DM_URL, {"employee_code": employee_code, "message": message}, token)
+    return _seatalk_json(r)
+
+async def send_to_group(token: str, group_id: str, message: dict):
+    r = await _post("group_chat", GROUP_DM_URL, {"group_id": group_id, "message": message}, token)
+    return _seatalk_json(r)
+
+# ========= Retry (mesma política/orçamento do app.py) =========
+def _is_retryable(e: Exception, idempotent: bool = False) -> bool:
+    if isinstance(e, CircuitOpenError):
+        return False
+    # sem conexão/slot o pedido nem saiu; ReadTimeout etc. só em chamadas idempotentes
+    if isinstance(e, (TokenExpiredError, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(e, httpx.TransportError):
+        return idempotent
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code in (401, 429)
+    return False
+
+async def _call_with_retry(fn, stats: dict, idempotent: bool = False):
+    _retry_deposit()
+    attempt = 0
+    while True:
+        attempt += 1
+        stats["attempts"] = stats.get("attempts", 0) + 1
+        try:
+            return await fn(await get_token())
+        except Exception as e:
+            if attempt >= RETRY_MAX_ATTEMPTS or not _is_retryable(e, idempotent) or not _retry_withdraw():
+                raise
+            if isinstance(e, TokenExpiredError) or (
+                    isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 401):
+                core._token.update({"v": None, "exp": 0})
+                continue
+            await asyncio.sleep(random.uniform(0, min(RETRY_MAX_SEC, RETRY_BASE_SEC * 2 ** (attempt - 1))))
+
+async def _broadcast(targets: list, field: str, send) -> list:
+    """Envia para todos com no máximo ASYNC_SEND_CONCURRENCY em voo; mantém a ordem dos resultados."""
+    sem = asyncio.Semaphore(ASYNC_SEND_CONCURRENCY)
+
+    async def _one(t):
+        st = {"attempts": 0}
+        async with sem:
+            try:
+                rj = await send(t, st)
+                return {field: t, "ok": True, "resp": rj, "attempts": st["attempts"]}
+            except Exception as e:
+                return {field: t, "ok": False, "error": str(e), "attempts": st["attempts"]}
+
+    return list(await asyncio.gather(*(_one(t) for t in targets)))
+
+def _to_employee(message: dict):
+    async def _send(em, st):
+        emp_code = await _call_with_retry(lambda tk: resolve_employee_code(tk, em), st, idempotent=True)
+        return await _call_with_retry(lambda tk: send_to_employee(tk, emp_code, message), st)
+    return _send
+
+def _to_group(message: dict):
+    return lambda gid, st: _call_with_retry(lambda tk: send_to_group(tk, gid, message), st)
+
+# ========= Google Sheets (API REST) =========
+_sa_creds = None
+_sa_lock = asyncio.Lock()
+_sheets_ready = set()  # (sheet_id, sheet_name) com aba e cabeçalho já garantidos
+
+async def _sheets_headers() -> dict:
+    global _sa_creds
+    async with _sa_lock:
+        if _sa_creds is None:
+            creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON") or ""
+            if not creds_json:
+                raise RuntimeError("GOOGLE_CREDENTIALS_JSON não configurada")
+            from google.oauth2.service_account import Credentials
+            _sa_creds = Credentials.from_service_account_info(
+                _json_loads(creds_json), scopes=["https://www.googleapis.com/auth/spreadsheets"])
+        if not _sa_creds.valid:
+            from google.auth.transport.requests import Request
+            await asyncio.to_thread(_sa_creds.refresh, Request())  # raro: ~1x por hora
+        return {"Authorization": f"Bearer {_sa_creds.token}", "Content-Type": "application/json"}
+
+async def _ensure_sheet(h: dict, sid: str, sname: str):
+    rng = quote(f"'{sname}'!A1:E1", safe="")
+    r = await _client.get(f"{SHEETS_API}/{sid}/values/{rng}", headers=h, timeout=10)
+    if r.status_code == 400:  # aba inexistente
+        req = {"requests": [{"addSheet": {"properties": {
+            "title": sname, "gridProperties": {"rowCount": 100, "columnCount": 10}}}}]}
+        (await _client.post(f"{SHEETS_API}/{sid}:batchUpdate", headers=h, content=_json_dumps(req),
+                            timeout=10)).raise_for_status()
+        values = []
+    else:
+        r.raise_for_status()
+        values = _json_loads(r.content).get("values") or []
+    if not values or not any(values[0]):
+        body = {"values": [["timestamp_utc", "email_or_id", "action", "message_id", "group_id"]]}
+        (await _client.put(f"{SHEETS_API}/{sid}/values/{rng}", params={"valueInputOption": "RAW"},
+                           headers=h, content=_json_dumps(body), timeout=10)).raise_for_status()
+
+def _is_sheets_outage(e: Exception) -> bool:
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    try:
+        from google.auth.exceptions import TransportError as GoogleTransportError
+    except ImportError:
+        GoogleTransportError = ()
+    return isinstance(e, GoogleTransportError)
+
+async def _append_click_row(ts_iso, email_or_id, action, message_id, group_id, sheet_id=None, sheet_name=None):
+    sid = (sheet_id or GOOGLE_SHEET_ID or "").strip()
+    sname = (sheet_name or GOOGLE_SHEET_NAME or "seatalk_logs").strip()
+    if not sid:
+        return
+    br = _breakers["sheets"]
+    br.before()
+    try:
+        h = await _sheets_headers()
+        if (sid, sname) not in _sheets_ready:
+            await _ensure_sheet(h, sid, sname)
+            _sheets_ready.add((sid, sname))
+        body = {"values": [[ts_iso, email_or_id, action, message_id, group_id]]}
+        rng = quote(f"'{sname}'!A:E", safe="")
+        r = await _client.post(f"{SHEETS_API}/{sid}/values/{rng}:append",
+                               params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+                               headers=h, content=_json_dumps(body), timeout=10)
+        r.raise_for_status()
+    except Exception as e:
+        # 4xx (planilha inexistente/sem permissão) é erro do botão, não queda do Sheets
+        br.record(not _is_sheets_outage(e))
+        raise
+    br.record(True)
+
+# ========= Rotas =========
+async def health(request):
+    return PlainTextResponse("ok")
+
+async def ready(request):
+    body = core._ready_snapshot()
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+async def status(request):
+    return JSONResponse({**core._status_snapshot(), "server_mode": "asgi", "background": len(_background)})
+
+async def _step(name: str, coro):
+    try:
+        await coro
+    except Exception as e:
+        print(f"{name} error:", repr(e))
+
+async def seatalk_callback(request):
+    t0 = time.monotonic()
+    if len(_background) >= core.BACKGROUND_MAX_PENDING:
+        # background já está atrasado; 503 faz o SeaTalk reenviar depois (igual ao modo threaded)
+        with core._admission_lock:
+            core._admission["callback"]["shed"] += 1
+        return JSONResponse({"error": "sobrecarga, tente novamente"}, status_code=503,
+                            headers={"Retry-After": str(core.RETRY_AFTER_SEC)})
+    raw = await request.body()
+    try:
+        data = _json_loads(raw)
+    except Exception:
+        return PlainTextResponse("invalid json", status_code=400)
+    if not isinstance(data, dict):
+        return PlainTextResponse("invalid json", status_code=400)
+    etype = str(data.get("event_type", ""))
+    sig   = request.headers.get("signature") or ""
+
+    if etype == "event_verification":
+        ch = (data.get("event") or {}).get("seatalk_challenge")
+        return JSONResponse({"seatalk_challenge": ch})
+
+    if SEATALK_SIGNING_SECRET:
+        sig_ok = signature_matches(raw, sig)
+        # if not sig_ok: return PlainTextResponse("unauthorized", status_code=403)
+
+    if etype == "interactive_message_click":
+        evt        = data.get("event") or {}
+        message_id = str(evt.get("message_id", ""))
+        value      = _decode_value(evt.get("value"))
+        action     = _extract_action(value)
+        meta       = _extract_sheet_meta(value)
+        email_or_id= str(evt.get("email") or evt.get("seatalk_id") or "")
+        group_id   = str(evt.get("group_id") or evt.get("chat_id") or "")
+        ts_iso     = datetime.now(timezone.utc).isoformat()
+
+        async def _send_thanks():
+            token = await get_token()
+            msg = text_message("Resposta enviada")
+            if group_id:
+                await send_to_group(token, group_id, msg)
+            elif email_or_id and "@" in email_or_id:
+                await send_to_employee(token, await resolve_employee_code(token, email_or_id), msg)
+            else:
+                print("no direct target to thank (missing group_id/email)")
+
+        tasks = {
+            asyncio.create_task(_step("sheets log", _append_click_row(
+                ts_iso, email_or_id, action, message_id, group_id,
+                sheet_id=meta.get("sheet_id"), sheet_name=meta.get("sheet_name")))),
+            asyncio.create_task(_step("send thank text", _send_thanks())),
+        }
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, t0 + CALLBACK_DEADLINE_SEC - time.monotonic()))
+        if pending:
+            # mesmo contrato do modo threaded: o que não coube no deadline segue em background
+            with core._bg_lock:
+                core._bg_stats["deferred"] += len(pending)
+            for t in pending:
+                _background.add(t)
+                t.add_done_callback(_background.discard)
+        core._note_callback_latency(time.monotonic() - t0)
+
+    return PlainTextResponse("ok")
+
+async def ui_send(request):
+    body, code, headers = core._ui_response(request.headers.get("accept-encoding", ""),
+                                            request.headers.get("if-none-match", ""))
+    media = headers.pop("Content-Type", None)
+    return Response(body, status_code=code, headers=headers, media_type=media)
+
+def _check_ui_auth(request):
+    if not UI_ADMIN_TOKEN:
+        return None
+    if request.headers.get("x-admin-token", "") != UI_ADMIN_TOKEN:
+        return JSONResponse({"error": "unauthorized"}, status_code=403)
+    return None
+
+async def _send_api(request, kind: str):
+    """Casca comum das APIs: auth, body JSON, validação de core._send_request e broadcast."""
+    auth_resp = _check_ui_auth(request)
+    if auth_resp:
+        return auth_resp
+    try:
+        body = _json_loads(await request.body() or b"{}") or {}
+        try:
+            field, targets, message = _send_request(kind, body)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        send = (_to_employee if field == "email" else _to_group)(message)
+        await get_token()  # falha cedo se a autenticação estiver indisponível
+        return JSONResponse({"sent": await _broadcast(targets, field, send)})
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+def _api(kind: str):
+    async def _endpoint(request):
+        return await _send_api(request, kind)
+    return _endpoint
+
+async def _warmup():
+    """
+    Warm-up deste modo: token SeaTalk e handshake TLS pelo AsyncClient,
+    credenciais do Sheets (_sheets_headers) e aba/cabeçalho da planilha padrão.
+    Preenche core._warmup como o warm-up do modo threaded, para o /ready.
+    """
+    async def _warm(name, coro):
+        t = time.monotonic()
+        try:
+            await coro
+            core._warmup["steps"][name] = {"ok": True, "ms": round((time.monotonic() - t) * 1000)}
+        except Exception as e:
+            core._warmup["steps"][name] = {"ok": False, "ms": round((time.monotonic() - t) * 1000), "error": repr(e)}
+            print(f"warmup {name} error:", repr(e))
+
+    async def _sheets():
+        h = await _sheets_headers()
+        if GOOGLE_SHEET_ID:
+            await _ensure_sheet(h, GOOGLE_SHEET_ID, GOOGLE_SHEET_NAME)
+            _sheets_ready.add((GOOGLE_SHEET_ID, GOOGLE_SHEET_NAME))
+
+    if core.SEATALK_APP_ID and core.SEATALK_APP_SECRET:
+        await _warm("token", get_token())
+    if os.getenv("GOOGLE_CREDENTIALS_JSON"):
+        await _warm("sheets", _sheets())
+    core._warmup["warmup_sec"] = round(time.monotonic() - core._BOOT_TS, 3)
+    core._warmup["done"] = True
+    print(f"warmup done in {core._warmup['warmup_sec']}s:", core._warmup["steps"])
+
+@asynccontextmanager
+async def _lifespan(_app):
+    global _client
+    core._start_scheduler_thread()
+    core._start_keepalive_thread()
+    _client = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                                                    max_keepalive_connections=ASYNC_MAX_CONNECTIONS))
+    warm = asyncio.create_task(_warmup())  # não atrasa o bind da porta; /ready reporta o fim
+    try:
+        yield
+    finally:
+        warm.cancel()
+        await _client.aclose()
+
+app = Starlette(lifespan=_lifespan, routes=[
+    Route("/", health, methods=["GET"]),
+    Route("/", seatalk_callback, methods=["POST"]),
+    Route("/ready", ready, methods=["GET"]),
+    Route("/status", status, methods=["GET"]),
+    Route("/callback", seatalk_callback, methods=["POST"]),
+    Route("/ui", ui_send, methods=["GET"]),
+    Route("/api/send-interactive", _api("interactive"), methods=["POST"]),
+    Route("/api/send-group-interactive", _api("group-interactive"), methods=["POST"]),
+    Route("/api/send-group-redirect", _api("group-redirect"), methods=["POST"]),
+    Route("/api/send-text", _api("text"), methods=["POST"]),
+    Route("/api/send-group-text", _api("group-text"), methods=["POST"]),
+])
@@ -0,0 +1,233 @@
+# bench.py
+"""
+Benchmarks locais do app.
+
+  python bench.py startup [--clicks 20]
+  python bench.py codec [--events 50000]
+  python bench.py modes [--callbacks 300] [--recipients 300] [--delay-ms 100]
+
+startup: sobe `python app.py` numa porta livre com as env vars atuais e mede
+tempo até o bind da porta, até /ready e a latência dos primeiros cliques em
+/callback (time-to-first-fast-callback). Use as mesmas env vars do Render
+(SEATALK_*, GOOGLE_*) para o número ser representativo.
+
+codec: CPU por evento de clique no caminho de parse do /callback — antes
+(get_json + json.loads do value duas vezes + comparação de strings) vs agora
+(parse único do buffer com o codec configurado, value decodificado uma vez,
+compare_digest) — e o custo de serializar um card de saída.
+
+modes: sobe um SeaTalk falso (latência fixa) e compara o modo threaded com o
+modo ASGI (SERVER_MODE=asgi): rajada de cliques concorrentes em /callback e um
+broadcast para N grupos em /api/send-group-text. Requer uvicorn/starlette/httpx.
+"""
+import os, sys, time, json, socket, subprocess, argparse
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _free_port() -> int:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _click_event() -> dict:
+    return {
+        "event_type": "interactive_message_click",
+        "event": {
+            "message_id": "bench",
+            "value": json.dumps({"acao": "bench"}),
+            "group_id": os.getenv("BENCH_GROUP_ID", ""),
+            "email": os.getenv("BENCH_EMAIL", ""),
+        },
+    }
+
+def bench_startup(clicks: int):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, PORT=str(port))
+    t0 = time.monotonic()
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "app.py")], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        bound = ready = None
+        while time.monotonic() - t0 < 60:
+            try:
+                if bound is None and requests.get(base + "/", timeout=1).status_code == 200:
+                    bound = time.monotonic() - t0
+                if bound is not None and requests.get(base + "/ready", timeout=1).status_code == 200:
+                    ready = time.monotonic() - t0
+                    break
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.05)
+        print(f"port bound: {bound:.3f}s" if bound is not None else "port bound: timeout")
+        print(f"ready:      {ready:.3f}s" if ready is not None else "ready:      timeout")
+
+        lat = []
+        for _ in range(clicks):
+            t = time.monotonic()
+            requests.post(base + "/callback", json=_click_event(), timeout=30)
+            lat.append((time.monotonic() - t) * 1000)
+        if lat:
+            print(f"callbacks:  first {lat[0]:.0f} ms, p50 {sorted(lat)[len(lat)//2]:.0f} ms, max {max(lat):.0f} ms")
+        info = requests.get(base + "/ready", timeout=5).json()
+        print("first_fast_callback_sec:", info.get("first_fast_callback_sec"))
+        print("warmup steps:", info.get("steps"))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+def make_fake_upstream():
+    """SeaTalk falso p/ o bench (uvicorn --factory bench:make_fake_upstream)."""
+    import asyncio
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+    delay = float(os.getenv("FAKE_DELAY_MS") or "100") / 1000
+
+    async def _ok(request):
+        await asyncio.sleep(delay)
+        return JSONResponse({"code": 0, "access_token": "bench", "expires_in": 7200,
+                             "employees": [{"employee_status": 2, "employee_code": "E"}]})
+    return Starlette(routes=[Route("/{path:path}", _ok, methods=["POST"])])
+
+def _wait_up(url: str, proc, timeout: float = 30):
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f"processo saiu com código {proc.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    raise RuntimeError(f"timeout esperando {url}")
+
+def _pct(vals: list, p: float) -> float:
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(len(vals) * p))]
+
+async def _load(base: str, callbacks: int, recipients: int) -> dict:
+    import asyncio, httpx
+    out = {}
+    limits = httpx.Limits(max_connections=callbacks + 10)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as c:
+        async def _click(i):
+            evt = _click_event()
+            evt["event"]["group_id"] = f"GRUPO{i:06d}"
+            t = time.monotonic()
+            r = await c.post(base + "/callback", json=evt)
+            return (time.monotonic() - t) * 1000, r.status_code
+
+        t0 = time.monotonic()
+        res = await asyncio.gather(*(_click(i) for i in range(callbacks)))
+        lat = [ms for ms, code in res if code == 200]
+        out["callbacks"] = {
+            "wall_s": round(time.monotonic() - t0, 2), "ok": len(lat), "shed": callbacks - len(lat),
+            "p50_ms": round(_pct(lat, 0.5)) if lat else None, "p99_ms": round(_pct(lat, 0.99)) if lat else None,
+        }
+        await asyncio.sleep(1)  # deixa terminar o que foi adiado p/ background
+        st = (await c.get(base + "/status")).json()
+        out["callbacks"]["deferred"] = st["callback"]["deferred"]
+
+        t0 = time.monotonic()
+        r = await c.post(base + "/api/send-group-text",
+                         json={"group_ids": [f"GRUPO{i:06d}" for i in range(recipients)], "text": "bench"})
+        sent = r.json().get("sent") or []
+        out["broadcast"] = {"wall_s": round(time.monotonic() - t0, 2), "ok": sum(1 for x in sent if x.get("ok"))}
+    return out
+
+def bench_modes(callbacks: int, recipients: int, delay_ms: float):
+    import asyncio
+    up_port = _free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--factory", "bench:make_fake_upstream", "--port", str(up_port),
+         "--log-level", "warning"], cwd=HERE, env=dict(os.environ, FAKE_DELAY_MS=str(delay_ms)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_up(f"http://127.0.0.1:{up_port}/", upstream)
+        for mode in ("threaded", "asgi"):
+            port = _free_port()
+            env = dict(os.environ, PORT=str(port), SERVER_MODE=mode,
+                       SEATALK_API_BASE=f"http://127.0.0.1:{up_port}",
+                       SEATALK_APP_ID="bench", SEATALK_APP_SECRET="bench",
+                       MAX_INFLIGHT_CALLBACK=str(callbacks * 2), MAX_INFLIGHT_SEND="10",
+                       BACKGROUND_MAX_PENDING=str(callbacks * 4),
+                       SCHEDULER_DB=os.path.join(HERE, f".bench_{mode}.db"))
+            env.pop("GOOGLE_SHEET_ID", None)
+            proc = subprocess.Popen([sys.executable, os.path.join(HERE, "app.py")], env=env,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                _wait_up(f"http://127.0.0.1:{port}/", proc)
+                print(f"{mode:9s}", asyncio.run(_load(f"http://127.0.0.1:{port}", callbacks, recipients)))
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+                if os.path.exists(env["SCHEDULER_DB"]):
+                    os.remove(env["SCHEDULER_DB"])
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+def _cpu_us(fn, n: int) -> float:
+    t = time.process_time()
+    for _ in range(n):
+        fn()
+    return (time.process_time() - t) / n * 1e6
+
+def bench_codec(events: int):
+    import hashlib, hmac
+    os.environ.setdefault("SEATALK_SIGNING_SECRET", "bench-secret")
+    sys.path.insert(0, HERE)
+    import app
+
+    evt = _click_event()
+    evt["event"]["value"] = json.dumps({"acao": "sim", "sheet_id": "1A2b3C4d5E6f7G8h9I0j", "sheet_name": "seatalk_logs"})
+    evt["event"].update({"email": "alguem@empresa.com", "seatalk_id": "1234567890", "group_id": "OTc3OTg4MjY2NTk0"})
+    raw = json.dumps(evt).encode()
+    secret = app.SEATALK_SIGNING_SECRET.encode()
+    sig = hashlib.sha256(raw + secret).hexdigest()
+
+    def before():
+        data = json.loads(raw)  # request.get_json(force=True)
+        value = data["event"]["value"]
+        json.loads(value)       # _extract_action
+        json.loads(value)       # _extract_sheet_meta
+        calc = hashlib.sha256(raw + secret).hexdigest()
+        return calc.lower() == sig.lower()
+
+    def after():
+        data = app._json_loads(raw)
+        value = app._decode_value(data["event"]["value"])
+        app._extract_action(value)
+        app._extract_sheet_meta(value)
+        return hmac.compare_digest(app.expected_signature(raw).encode(), sig.encode())
+
+    elements = app.build_elements("📌 Confirme sua leitura", "Escolha uma das opções abaixo.",
+                                  [{"text": "✅ Sim", "action": "sim"}, {"text": "❌ Não", "action": "nao"}])
+    payload = {"group_id": "OTc3OTg4MjY2NTk0",
+               "message": {"tag": "interactive_message", "interactive_message": {"elements": elements}}}
+
+    b, a = _cpu_us(before, events), _cpu_us(after, events)
+    eb, ea = _cpu_us(lambda: json.dumps(payload).encode(), events), _cpu_us(lambda: app._json_dumps(payload), events)
+    print(f"codec: {app.JSON_CODEC}  ({events} eventos)")
+    print(f"callback parse: antes {b:.2f} us/evento, agora {a:.2f} us/evento ({(1 - a / b) * 100:.0f}% menos CPU)")
+    print(f"card encode:    stdlib {eb:.2f} us, codec {ea:.2f} us")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("which", choices=["startup", "codec", "modes"])
+    ap.add_argument("--clicks", type=int, default=20)
+    ap.add_argument("--events", type=int, default=50000)
+    ap.add_argument("--callbacks", type=int, default=300)
+    ap.add_argument("--recipients", type=int, default=300)
+    ap.add_argument("--delay-ms", type=float, default=100)
+    args = ap.parse_args()
+    if args.which == "startup":
+        bench_startup(args.clicks)
+    elif args.which == "codec":
+        bench_codec(args.events)
+    elif args.which == "modes":
+        bench_modes(args.callbacks, args.recipients, args.delay_ms)